@@ -20,14 +20,21 @@ and any user provided settings file.
 
 # pylint: disable=invalid-name
 
-import copy
+import ast
+import functools
 import os
 import re
+import sys
 import logging
-import pprint
 
 _LOGGER = logging.getLogger(__name__)
 
+# sentinel for missing dictionary items
+_MISSING = object()
+
+# types of values, which can't be modified in place
+_IMMUTABLE_TYPES = (str, bytes, int, float, complex, type(None))
+
 # regex to parse configuration macros from 04_vnf.conf
 # it will select all patterns starting with # sign
 # and returns macro parameters and step
@@ -37,30 +44,153 @@ _LOGGER = logging.getLogger(__name__)
 #   #IP(192.168.1.2) or #IP(192.168.1.2,2)
 #   #EVAL(2*#VMINDEX)
 _PARSE_PATTERN = r'(#[A-Z]+)(\(([^(),]+)(,([0-9]+))?\))?'
+_PARSE_RE = re.compile(_PARSE_PATTERN)
+
+# regex to validate references to other parameters used by #PARAM macro,
+# i.e. NAME or NAME[key][idx]; it is applied to the text between
+# parentheses only, so it can't backtrack over the whole value
+_PARAM_REF_RE = re.compile(r'([\w\-]+)(\[[\w\[\]\-\'\"]+\])?')
+
+# regex to match names of configuration files, e.g. 03_foo.conf, 05a_bar.conf
+_CONF_FILE_RE = re.compile(
+    "^(?P<digit_part>[0-9]+)(?P<alfa_part>[a-z]?)_.*.conf$")
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_subscripts(subscript_src):
+    """Return tuple of keys from subscript chain, e.g. "['x'][0]" -> ('x', 0)
+
+    Only literal keys are allowed; a malformed chain or any other key,
+    e.g. a name or a slice, raises ``ValueError``.
+    """
+    try:
+        node = ast.parse('_' + subscript_src, mode='eval').body
+        keys = []
+        while isinstance(node, ast.Subscript):
+            key = node.slice
+            # python < 3.9 wraps the key into ast.Index
+            if sys.version_info < (3, 9) and isinstance(key, ast.Index):
+                key = key.value
+            keys.append(ast.literal_eval(key))
+            node = node.value
+    except (SyntaxError, ValueError):
+        node = None
+    if not isinstance(node, ast.Name) or node.id != '_':
+        raise ValueError("Invalid subscript %r" % subscript_src)
+    return tuple(reversed(keys))
+
+
+def _resolve_subscripts(value, subscript_src):
+    """Apply subscript chain ``subscript_src`` (e.g. "['x'][0]") to ``value``
+    """
+    for key in _parse_subscripts(subscript_src):
+        value = value[key]
+    return value
+
+
+def _find_param_macros(value):
+    """Return list of (reference, name, subscripts) for every #PARAM macro
+
+    E.g. "#PARAM(NAME['x'][0])" gives ("NAME['x'][0]", 'NAME', "['x'][0]").
+    """
+    macros = []
+    start = value.find('#PARAM(')
+    end = -1
+    while start >= 0:
+        begin = start + len('#PARAM(')
+        # macros without a valid reference may share the same closing
+        # parenthesis; look for the next one only once it is passed
+        if begin > end:
+            end = value.find(')', begin)
+            if end < 0:
+                # there is no closing parenthesis for any following macro
+                break
+        match_object = _PARAM_REF_RE.fullmatch(value, begin, end)
+        if match_object:
+            macros.append((match_object.group(0),
+                           match_object.group(1),
+                           match_object.group(2) or ''))
+            start = value.find('#PARAM(', end + 1)
+        else:
+            start = value.find('#PARAM(', start + 1)
+    return macros
+
+
+def _has_macros(value):
+    """Check if ``value`` contains #PARAM macro at any depth
+    """
+    if isinstance(value, str):
+        return '#PARAM(' in value
+    elif isinstance(value, (list, tuple)):
+        return any(_has_macros(item) for item in value)
+    elif isinstance(value, dict):
+        return any(_has_macros(item) for item in value.values())
+    else:
+        return False
+
+
+def _copy_containers(value):
+    """Return copy of ``value`` with all nested lists, tuples and dicts copied
+
+    Other objects are shared with ``value``.
+    """
+    if isinstance(value, list):
+        return [_copy_containers(item) for item in value]
+    elif isinstance(value, tuple):
+        return tuple(_copy_containers(item) for item in value)
+    elif isinstance(value, dict):
+        return {key: _copy_containers(item) for (key, item) in value.items()}
+    else:
+        return value
+
+
+def parse_macros(value):
+    """Return list of macros found in string ``value``
+
+    Every macro is returned as a tuple of groups of ``_PARSE_PATTERN``,
+    i.e. (name, parentheses, parameter, comma and step, step).
+    """
+    # values without any macro are common, so skip the regex for them
+    if '#' not in value:
+        return []
+    return _PARSE_RE.findall(value)
 
 
 class Settings(object):
     """Holding class for settings.
     """
+    __slots__ = ('_values', '_expanded_cache', '_macro_flags', '_any_macros')
+
     def __init__(self):
-        pass
+        # values of all settings
+        super(Settings, self).__setattr__('_values', {})
+        # expanded values of settings; it is dropped whenever any
+        # setting is modified, because #PARAM macros can refer to it
+        super(Settings, self).__setattr__('_expanded_cache', {})
+        # flags, whether settings contain any #PARAM macro at all; raw
+        # access to a mutable setting sets its flag, as it can be modified
+        # in place
+        super(Settings, self).__setattr__('_macro_flags', {})
+        # set once any setting with #PARAM macro is stored or any mutable
+        # setting is accessed raw; it is not reset on overwrite, so it may
+        # only give a false positive
+        super(Settings, self).__setattr__('_any_macros', False)
 
     def _eval_param(self, param):
         # pylint: disable=invalid-name
         """ Helper function for expansion of references to 'valid' parameters
         """
         if isinstance(param, str):
+            # cheap substring check; most values don't contain any macro
+            if '#PARAM(' not in param:
+                return param
             # evaluate every #PARAM reference inside parameter itself
-            macros = re.findall(
-                r'#PARAM\((([\w\-]+)(\[[\w\[\]\-\'\"]+\])*)\)',
-                param)
+            macros = _find_param_macros(param)
             if macros:
                 for macro in macros:
-                    # pylint: disable=eval-used
                     try:
-                        tmp_val = str(
-                            eval("self.getValue('{}'){}".format(macro[1],
-                                                                macro[2])))
+                        tmp_val = str(_resolve_subscripts(
+                            self.getValue(macro[1]), macro[2]))
                         param = param.replace('#PARAM({})'.format(macro[0]),
                                               tmp_val)
                     # silently ignore that option required by
@@ -68,36 +198,111 @@ class Settings(object):
                     # It is possible, that referred parameter
                     # will be constructed during runtime
                     # and re-read later.
+                    # Malformed subscripts are configuration errors,
+                    # so their ValueError is not ignored.
                     except IndexError:
                         pass
                     except AttributeError:
                         pass
             return param
-        elif isinstance(param, (list, tuple)):
-            tmp_list = []
-            for item in param:
-                tmp_list.append(self._eval_param(item))
-            return tmp_list
+        elif isinstance(param, list):
+            eval_param = self._eval_param
+            return [eval_param(item) for item in param]
+        elif isinstance(param, tuple):
+            eval_param = self._eval_param
+            return tuple(eval_param(item) for item in param)
         elif isinstance(param, dict):
-            tmp_dict = {}
-            for (key, value) in param.items():
-                tmp_dict[key] = self._eval_param(value)
-            return tmp_dict
+            eval_param = self._eval_param
+            return {key: eval_param(value) for (key, value) in param.items()}
         else:
             return param
 
     def getValue(self, attr):
         """Return a settings item value
+
+        Expanded values are cached, but every caller gets its own copy
+        of lists, tuples and dicts, so it can modify them freely. The only
+        exception is TEST_PARAMS, which is returned as it is stored. It
+        can be modified in place, so expansions are not trusted afterwards:
+
+            >>> conf = Settings()
+            >>> conf.setValue('TEST_PARAMS', {'x': 1})
+            >>> conf.setValue('A', "#PARAM(TEST_PARAMS['x'])")
+            >>> conf.getValue('A')
+            '1'
+            >>> conf.getValue('TEST_PARAMS')['x'] = 2
+            >>> conf.getValue('A')
+            '2'
         """
-        if attr in self.__dict__:
-            if attr == 'TEST_PARAMS':
-                return getattr(self, attr)
-            else:
-                master_value = getattr(self, attr)
-                return self._eval_param(master_value)
-        else:
+        value = self._values.get(attr, _MISSING)
+        if value is _MISSING:
             raise AttributeError("%r object has no attribute %r" %
                                  (self.__class__, attr))
+        if attr == 'TEST_PARAMS':
+            self._handed_out(attr, value)
+            return value
+        if not self._any_macros or not self._macro_flags[attr]:
+            return _copy_containers(value)
+
+        expanded = self._expanded_cache.get(attr, _MISSING)
+        if expanded is _MISSING:
+            expanded = self._eval_param(value)
+            self._expanded_cache[attr] = expanded
+        return _copy_containers(expanded)
+
+    def _get_raw(self, name):
+        """Return a raw (i.e. unexpanded) value of setting
+        """
+        # internal state is not initialized yet, e.g. before __setstate__
+        if name in Settings.__slots__:
+            raise AttributeError(name)
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError("%r object has no attribute %r" %
+                                 (self.__class__, name)) from None
+
+    def __getattr__(self, name):
+        """Return a raw (i.e. unexpanded) value of setting
+
+        The value can be modified in place, e.g. settings.A.append(3),
+        so it may contain macros from now on and expansions of macros
+        referring to it can't be trusted anymore.
+        """
+        value = self._get_raw(name)
+        self._handed_out(name, value)
+        return value
+
+    def _handed_out(self, name, value):
+        """Forget everything derived from stored ``value`` given to a caller
+
+        Unless ``value`` is immutable, the caller can modify it in place.
+        Then it may contain macros, and expansions referring to it are
+        outdated. TEST_PARAMS is never expanded, so its flag is kept.
+        """
+        if isinstance(value, _IMMUTABLE_TYPES):
+            return
+        if name != 'TEST_PARAMS':
+            self._macro_flags[name] = True
+            if not self._any_macros:
+                super(Settings, self).__setattr__('_any_macros', True)
+        self._expanded_cache.clear()
+
+    def __getstate__(self):
+        """Return state for copy and pickle modules
+        """
+        return {'_values': dict(self._values),
+                '_macro_flags': dict(self._macro_flags),
+                '_any_macros': self._any_macros}
+
+    def __setstate__(self, state):
+        """Restore state created by __getstate__
+
+        __setattr__ would skip the internal state, so it is set directly.
+        """
+        for name, value in state.items():
+            super(Settings, self).__setattr__(name, value)
+        super(Settings, self).__setattr__('_expanded_cache', {})
 
     def __setattr__(self, name, value):
         """Set a value
@@ -107,24 +312,39 @@ class Settings(object):
             return
 
         # we can assume all uppercase keys are valid settings
-        super(Settings, self).__setattr__(name, value)
+        self._set_fast(name, value)
 
     def setValue(self, name, value):
         """Set a value
         """
         if name is not None and value is not None:
-            super(Settings, self).__setattr__(name, value)
+            self._set_fast(name, value)
+
+    def _set_fast(self, name, value):
+        """Set a value of setting, which name is already known to be valid
+        """
+        self._values[name] = value
+        has_macros = _has_macros(value)
+        self._macro_flags[name] = has_macros
+        if has_macros and not self._any_macros:
+            super(Settings, self).__setattr__('_any_macros', True)
+        self._expanded_cache.clear()
 
     def load_from_file(self, path):
         """Update ``settings`` with values found in module at ``path``.
         """
-        import imp
+        with open(path, 'rb') as conf_file:
+            source = conf_file.read()
 
-        custom_settings = imp.load_source('custom_settings', path)
+        # conf files are plain python modules, but there is no need
+        # to register them in sys.modules or to write their bytecode
+        custom_settings = {'__file__': path}
+        # pylint: disable=exec-used
+        exec(compile(source, path, 'exec'), custom_settings)
 
-        for key in dir(custom_settings):
-            if getattr(custom_settings, key) is not None:
-                setattr(self, key, getattr(custom_settings, key))
+        for key, value in custom_settings.items():
+            if key.isupper() and value is not None:
+                self._set_fast(key, value)
 
     def load_from_dir(self, dir_path):
         """Update ``settings`` with contents of the .conf files at ``path``.
@@ -139,31 +359,22 @@ class Settings(object):
 
         :returns: None
         """
-        regex = re.compile(
-            "^(?P<digit_part>[0-9]+)(?P<alfa_part>[a-z]?)_.*.conf$")
-
-        def get_prefix(filename):
-            """
-            Provide a suitable function for sort's key arg
-            """
-            match_object = regex.search(os.path.basename(filename))
-            return [int(match_object.group('digit_part')),
-                    match_object.group('alfa_part')]
-
-        # get full file path to all files & dirs in dir_path
-        file_paths = os.listdir(dir_path)
-        file_paths = [os.path.join(dir_path, x) for x in file_paths]
-
-        # filter to get only those that are a files, with a leading
-        # digit and end in '.conf'
-        file_paths = [x for x in file_paths if os.path.isfile(x) and
-                      regex.search(os.path.basename(x))]
+        # get only those entries that are files, with a leading
+        # digit and end in '.conf'; keep their prefix for sorting
+        file_paths = []
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                match_object = _CONF_FILE_RE.match(entry.name)
+                if match_object and entry.is_file():
+                    file_paths.append((int(match_object.group('digit_part')),
+                                       match_object.group('alfa_part'),
+                                       entry.path))
 
         # sort ascending on the leading digits and afla (e.g. 03_, 05a_)
-        file_paths.sort(key=get_prefix)
+        file_paths.sort()
 
         # load settings from each file in turn
-        for filepath in file_paths:
+        for _, _, filepath in file_paths:
             self.load_from_file(filepath)
 
     def load_from_dict(self, conf):
@@ -176,10 +387,10 @@ class Settings(object):
             if conf[key] is not None:
                 if isinstance(conf[key], dict):
                     # recursively update dict items, e.g. TEST_PARAMS
-                    setattr(self, key.upper(),
-                            merge_spec(getattr(self, key.upper()), conf[key]))
+                    self._set_fast(key.upper(), merge_spec(
+                        self._get_raw(key.upper()), conf[key]))
                 else:
-                    setattr(self, key.upper(), conf[key])
+                    self._set_fast(key.upper(), conf[key])
 
     def restore_from_dict(self, conf):
         """
@@ -188,17 +399,30 @@ class Settings(object):
         Method will drop all configuration options and restore their
         values from conf dictionary
         """
-        self.__dict__.clear()
-        tmp_conf = copy.deepcopy(conf)
-        for key in tmp_conf:
-            self.setValue(key, tmp_conf[key])
+        from copy import deepcopy
+
+        self._values.clear()
+        self._expanded_cache.clear()
+        self._macro_flags.clear()
+        super(Settings, self).__setattr__('_any_macros', False)
+        # objects shared by several values must stay shared in copies
+        memo = {}
+        for key, value in conf.items():
+            if value is not None:
+                # only containers must be copied; strings, numbers, etc.
+                # are immutable and can be shared with ``conf``
+                if isinstance(value, (dict, list, tuple, set, bytearray)):
+                    value = deepcopy(value, memo)
+                self._set_fast(key, value)
 
     def load_from_env(self):
         """
         Update ``settings`` with values found in the environment.
         """
-        for key in os.environ:
-            setattr(self, key, os.environ[key])
+        for key, value in os.environ.items():
+            # skip non-settings, like __setattr__ does
+            if key.isupper():
+                self._set_fast(key, value)
 
     def __str__(self):
         """Provide settings as a human-readable string.
@@ -208,11 +432,22 @@ class Settings(object):
         Returns:
             A human-readable string.
         """
-        tmp_dict = {}
-        for key in self.__dict__:
-            tmp_dict[key] = self.getValue(key)
-
-        return pprint.pformat(tmp_dict)
+        from pprint import pformat
+
+        # output is the same as pformat() of dict with all settings, but
+        # the dict is not built; pformat() of a single item dict gives
+        # the item exactly as it is formatted inside of the whole dict
+        items = []
+        for key, value in sorted(self._values.items()):
+            if self._any_macros:
+                value = self.getValue(key)
+            items.append(pformat({key: value})[1:-1])
+
+        # like pformat(), use a single line if all items fit on it
+        line = ', '.join(items)
+        if '\n' not in line and len(line) + 2 <= 80:
+            return '{' + line + '}'
+        return '{' + ',\n '.join(items) + '}'
 
     #
     # validation methods used by step driven testcases
@@ -228,7 +463,7 @@ class Settings(object):
     def validate_setValue(self, _dummy_result, name, value):
         """Verifies, that value was correctly set
         """
-        assert value == self.__dict__[name]
+        assert value == self._values[name]
         return True
 
 
@@ -247,19 +482,11 @@ def merge_spec(orig, new):
 
     You'll notice that ``bar.bar`` is not removed. This is the desired result.
     """
-    for key in orig:
-        if key not in new:
-            continue
-
-        # Not allowing derived dictionary types for now
-        # pylint: disable=unidiomatic-typecheck
-        if type(orig[key]) == dict:
-            orig[key] = merge_spec(orig[key], new[key])
+    for key, new_value in new.items():
+        orig_value = orig.get(key, _MISSING)
+        if isinstance(orig_value, dict) and isinstance(new_value, dict):
+            merge_spec(orig_value, new_value)
         else:
-            orig[key] = new[key]
-
-    for key in new:
-        if key not in orig:
-            orig[key] = new[key]
+            orig[key] = new_value
 
     return orig